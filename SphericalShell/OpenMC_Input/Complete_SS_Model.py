@@ -3,6 +3,7 @@ import openmc.deplete
 import numpy as np
 import yaml
 import argparse
+import os
 
 def alara_element_densities(elelib_fp):  
     '''
@@ -90,15 +91,63 @@ def make_settings(source, total_batches, inactive_batches, num_particles, run_mo
     sets.run_mode = run_mode
     return sets
 
-def deplete_ss(chain_file_path, model, inner_radius, thickness, timesteps, source_rates, norm_mode, timestep_units):
+def shell_volume(inner_radius, thickness):
+    return 4.0/3.0 * np.pi * ((inner_radius+thickness)**3 - inner_radius**3)
+
+def deplete_ss(chain_file_path, model, inner_radius, thickness, timesteps, source_rates, norm_mode, timestep_units, prev_results=None):
     chain_file = chain_file_path 
     material = model.materials[0]
     material.depletable = True
-    material.volume = 4.0/3.0 * np.pi * ((inner_radius+thickness)**3 - inner_radius**3)
-    operator = openmc.deplete.CoupledOperator(model, chain_file, normalization_mode = norm_mode)
+    material.volume = shell_volume(inner_radius, thickness)
+    operator = openmc.deplete.CoupledOperator(model, chain_file, prev_results = prev_results, normalization_mode = norm_mode)
     integrator = openmc.deplete.PredictorIntegrator(operator, timesteps, source_rates = source_rates, timestep_units = timestep_units)
     return integrator
 
+def load_completed_steps(results_file, params_file, run_params, material, volume, timesteps, source_rates, timestep_units):
+    '''
+    Reads an existing depletion results file and checks that it was produced by the same
+    model and irradiation schedule, so that depletion can continue from its last step.
+    
+    inputs:
+        results_file: path to OpenMC depletion results .h5 file (str)
+        params_file: path to the YAML file saved with results_file by run_depletion (str)
+        run_params: dictionary of the element, geometry and depletion inputs of the current run
+        material: depletable OpenMC Material object of the current run
+        volume: volume [cm^3] of the depletable material
+        timesteps: iterable of timesteps (not cumulative) of the full schedule
+        source_rates: iterable of source rates for each timestep
+        timestep_units: units of timesteps ('s', 'min', 'h', 'd', 'a')
+        
+    outputs:
+        prev_results: OpenMC depletion Results object, or None if results_file does not exist
+        num_completed: number of timesteps already completed (int)
+    '''
+    if not os.path.exists(results_file):
+        return None, 0
+    mismatch = f'{results_file} does not match the current inputs; remove it or run with --restart False.'
+    if not os.path.exists(params_file):
+        raise ValueError(f'{params_file} is missing, so {results_file} cannot be checked against the current inputs.')
+    with open(params_file, 'r') as file:
+        if yaml.safe_load(file) != run_params:
+            raise ValueError(mismatch)
+    prev_results = openmc.deplete.Results(filename=results_file)
+    initial_step = prev_results[0]
+    mat_id = str(material.id)
+    if mat_id not in initial_step.index_mat or not np.isclose(initial_step.volume[mat_id], volume):
+        raise ValueError(mismatch)
+    for nuclide, atom_density in material.get_nuclide_atom_densities().items():
+        # Number densities are in atom/b-cm; results hold the total number of atoms
+        if nuclide not in initial_step.index_nuc or not np.isclose(initial_step[0, mat_id, nuclide], atom_density * 1.0E+24 * volume):
+            raise ValueError(mismatch)
+    num_completed = len(prev_results) - 1
+    completed_times = prev_results.get_times(time_units = timestep_units)[1:]
+    completed_rates = [step_result.source_rate for step_result in prev_results[:num_completed]]
+    if num_completed > len(timesteps) or not (
+            np.allclose(completed_times, np.cumsum(timesteps)[:num_completed]) and
+            np.allclose(completed_rates, source_rates[:num_completed])):
+        raise ValueError(mismatch)
+    return prev_results, num_completed
+
 # Specify inputs and execute all functions:
 
 def parse_args():
@@ -110,6 +159,12 @@ def parse_args():
         choices=['True', 'False'],
         help='Specify whether to run depletion simulation (true/false)',
         )
+    parser.add_argument(
+        '--restart',
+        default = 'False',
+        choices=['True', 'False'],
+        help='Specify whether to continue depletion from an existing depletion_results.h5 (true/false)',
+        )
     args = parser.parse_args()
     return args
    
@@ -140,20 +195,46 @@ def create_model(inputs):
     model = openmc.model.Model(geometry = spherical_shell_geom, materials = materials, settings = sets, tallies = talls)
     return model
 
-def run_depletion(inputs):
+def run_depletion(inputs, restart=False):
     geom_info = inputs['geom_info']
     dep_params = inputs['depletion_params']
     model_file = dep_params['model_file']
     model = openmc.model.Model.from_model_xml(path=model_file)
+    timesteps = dep_params['times_post_boc']
+    source_rates = dep_params['source_rates']
+    # Inputs that must be unchanged for a previous depletion_results.h5 to be continued; the
+    # schedule itself may be extended and is checked step by step in load_completed_steps
+    run_params = {'element' : inputs['element'], 
+                  'geom_info' : geom_info, 
+                  'depletion_params' : {key: dep_params[key] for key in ['chain_file', 'norm_mode', 'timestep_units']}}
+    params_file = 'depletion_results_inputs.yaml'
+    
+    prev_results, num_completed = None, 0
+    if restart:
+        prev_results, num_completed = load_completed_steps('depletion_results.h5',
+                  params_file,
+                  run_params,
+                  model.materials[0],
+                  shell_volume(geom_info['inner_radius'], geom_info['thickness']),
+                  timesteps, 
+                  source_rates, 
+                  dep_params['timestep_units'])
+    if prev_results is None:
+        with open(params_file, 'w') as file:
+            yaml.safe_dump(run_params, file)
+    if num_completed == len(timesteps):
+        print('All depletion timesteps are already complete in depletion_results.h5')
+        return
     
     integrator = deplete_ss(dep_params['chain_file'],
               model, 
               geom_info['inner_radius'], 
               geom_info['thickness'], 
-              dep_params['timesteps'], 
-              dep_params['source_rates'],
+              timesteps[num_completed:], 
+              source_rates[num_completed:],
               dep_params['norm_mode'], 
-              dep_params['timestep_units'])     
+              dep_params['timestep_units'],
+              prev_results)     
     
     integrator.integrate() 
 
@@ -163,7 +244,7 @@ def main():
     model = create_model(inputs)
     model.export_to_model_xml()
     if args.run_depletion.lower() == 'true':
-        run_depletion(inputs)
+        run_depletion(inputs, args.restart.lower() == 'true')
 
 if __name__ == "__main__":
     main()
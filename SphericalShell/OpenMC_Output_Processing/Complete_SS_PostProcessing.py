@@ -5,34 +5,19 @@ import matplotlib.pyplot as plt
 import argparse
 import yaml
 
+# Shared statepoint reader at the repository root (run with the repository root on PYTHONPATH)
+from Tally_Reader import read_tally_mean, read_filter_bins, read_tally_ids, parse_filter_slices
+
 #Read tally data from statepoint:
 
-def extract_tally_values(statepoint_file_path) :
-    '''
-    Stores values from each tally in a numpy array
-    
-    inputs:
-        statepoint_file_path : path to OpenMC Statepoint .h5 file
-    '''
-    with openmc.StatePoint(statepoint_file_path) as sp:
-        tallies = sp.tallies
-    tally_array = []
-    for tally_id, tally in tallies.items():
-        tally_values = tally.get_values(value="mean").ravel()
-        tally_array.append(np.array(tally_values))
-    tally_array = np.array(tally_array) 
-    return tallies, tally_array
-    
-def plot_flux_spectrum(flux_tally, energy_filter_index) :
+def plot_flux_spectrum(flux_tally_values, energy_bins) :
     '''
     Plots flux tally as a function of energy
     
     inputs :
-        flux_tally : OpenMC Tally object that scores flux with energy filter
-        energy_filter_index : index of EnergyFilter within the list of applied filters
+        flux_tally_values : numpy array of flux tally means over the energy filter
+        energy_bins : iterable of lower bounds of each energy bin
     '''
-    flux_tally_values = flux_tally.get_values(value = 'mean').ravel()
-    energy_bins = flux_tally.filters[energy_filter_index].bins[:, 0]
     fix, ax = plt.subplots()
     ax.loglog(energy_bins, flux_tally_values, drawstyle='steps-post')
     ax.set_xlabel('Energy [eV]')
@@ -48,11 +33,12 @@ def save_tally_data(flux_tally_values, tally_array, inner_radius, thickness) :
     
     inputs :
         flux_tally_values : numpy array of neutron flux values over energy filter
-        tally_array : numpy array containing separate numpy arrays for each tally
+        tally_array : numpy array containing separate numpy arrays for each tally, or None to skip saving tally averages
         inner_radius : inner radius (float) of material 
         thickness: radial thickness (float) of material
     '''
-    np.savetxt('tally_averages', tally_array, fmt='%s')
+    if tally_array is not None:
+        np.savetxt('tally_averages', tally_array, fmt='%s')
     mat_vol = 4.0/3.0 * np.pi * ((inner_radius+thickness)**3 - inner_radius**3)
     flux = flux_tally_values/mat_vol
     #ALARA flux inputs go from high energy to low energy
@@ -146,11 +132,25 @@ def post_process_tallies(pp_inputs, model_inputs):
     indices = pp_inputs['indices']
     geom_info = model_inputs['geom_info']
         
-    tallies, tally_array = extract_tally_values(pp_inputs['filepaths']['statepoint_file_path'])
-        
-    flux_tally = tallies[indices['flux_tally_id']]
-    flux_tally_values, energy_bins = plot_flux_spectrum(flux_tally, 
-                      indices['energy_filter_index']) 
+    statepoint_file_path = filepaths['statepoint_file_path']
+    # Only the requested bins of the flux tally are read (e.g. one cell of the cell filter)
+    flux_filter_slices = parse_filter_slices(indices['flux_filter_slices'])
+    flux_tally_values = read_tally_mean(statepoint_file_path, 
+                      indices['flux_tally_id'], 
+                      flux_filter_slices).ravel()
+    # Energy filter bins are stored as bin edges; keep the lower bound of each bin
+    energy_bins = read_filter_bins(statepoint_file_path, 
+                      indices['flux_tally_id'], 
+                      indices['energy_filter_index'])[:-1]
+    flux_tally_values, energy_bins = plot_flux_spectrum(flux_tally_values, 
+                      energy_bins) 
+    
+    # Every tally is read in full only when the averages of all tallies are saved
+    tally_array = None
+    if pp_inputs['outputs']['save_tally_averages']:
+        tally_array = np.array([read_tally_mean(statepoint_file_path, tally_id).ravel() 
+                                if tally_id != indices['flux_tally_id'] or flux_filter_slices else flux_tally_values 
+                                for tally_id in read_tally_ids(statepoint_file_path)], dtype=object)
         
     tally_averages =  save_tally_data(flux_tally_values, tally_array, 
                                     geom_info['inner_radius'], 
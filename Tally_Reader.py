@@ -0,0 +1,167 @@
+import numpy as np
+import h5py
+
+#Read tally data directly from the HDF5 layout of an OpenMC statepoint.
+#Shared by the SphericalShell and WC_Layers post-processing; run those scripts with the repository root on PYTHONPATH.
+
+def parse_filter_slices(yaml_slices):
+    '''
+    Converts filter slices given in a YAML file to the form used by read_tally_mean.
+
+    inputs:
+        yaml_slices : dictionary with keys = index of a filter within the tally's filters and
+            values = bin index (int) or [start, stop] list of bins, or None
+    '''
+    if yaml_slices is None:
+        return {}
+    return {filter_index: slice(*bins) if isinstance(bins, list) else bins for filter_index, bins in yaml_slices.items()}
+
+def select_filter_rows(n_filter_bins, filter_bins):
+    '''
+    Builds the selection along the flattened filter-bin axis of a tally results dataset.
+    A plain slice is used when every filter is read in full, a strided hyperslab when a single
+    filter is restricted to contiguous bins, and a list of row indices otherwise.
+
+    inputs :
+        n_filter_bins : iterable of the number of bins of each filter (int)
+        filter_bins : iterable of numpy arrays of the ascending bins read along each filter
+    '''
+    restricted = [filter_index for filter_index, bins in enumerate(filter_bins)
+                  if len(bins) < n_filter_bins[filter_index]]
+    if not restricted:
+        return slice(None)
+    filter_index = restricted[0]
+    bins = filter_bins[filter_index]
+    if len(restricted) == 1 and np.all(np.diff(bins) == 1):
+        # Filters are flattened in C order, so the rows form blocks of equal length at a fixed stride
+        inner = int(np.prod(n_filter_bins[filter_index + 1:]))
+        outer = int(np.prod(n_filter_bins[:filter_index]))
+        return h5py.MultiBlockSlice(start=int(bins[0]) * inner, count=outer,
+                                    stride=n_filter_bins[filter_index] * inner, block=len(bins) * inner)
+    return np.ravel_multi_index(np.ix_(*filter_bins), n_filter_bins).ravel()
+
+def read_filter_bin_counts(sp, tally_group):
+    '''
+    Returns the number of bins (int) of each of a tally's filters.
+
+    inputs :
+        sp : open h5py File of an OpenMC Statepoint
+        tally_group : h5py Group of the tally
+    '''
+    filter_ids = tally_group['filters'][()] if tally_group['n_filters'][()] > 0 else []
+    return [int(sp['tallies']['filters'][f'filter {filter_id}']['n_bins'][()]) for filter_id in filter_ids]
+
+def read_tally_mean(statepoint_file_path, tally_id, filter_slices=None) :
+    '''
+    Reads the mean of a single tally directly from an OpenMC Statepoint file, loading
+    only the requested filter bins from the HDF5 results dataset.
+
+    inputs :
+        statepoint_file_path : path to OpenMC Statepoint .h5 file
+        tally_id : id of the tally to read (int)
+        filter_slices : dictionary with keys = index of a filter within the tally's filters
+            and values = bin index (int) or ascending slice of bins to read along that filter
+            (all bins are read for filters not in the dictionary)
+    outputs :
+        tally_mean : numpy array of tally means with one axis per filter followed by
+            one axis for nuclides and one for scores
+    '''
+    filter_slices = {} if filter_slices is None else filter_slices
+    with h5py.File(statepoint_file_path, 'r') as sp:
+        tally_group = sp['tallies'][f'tally {tally_id}']
+        n_realizations = tally_group['n_realizations'][()]
+        results = tally_group['results']
+        n_filter_bins = read_filter_bin_counts(sp, tally_group)
+        filter_bins = [np.atleast_1d(np.arange(n_bins)[filter_slices.get(filter_index, slice(None))])
+                       for filter_index, n_bins in enumerate(n_filter_bins)]
+        tally_sum = results[select_filter_rows(n_filter_bins, filter_bins), :, 0]
+        n_nuclides = len(tally_group['nuclides'][()])
+    tally_mean = tally_sum / n_realizations
+    slice_shape = tuple(len(bins) for bins in filter_bins)
+    return tally_mean.reshape(slice_shape + (n_nuclides, -1))
+
+def read_filter_sums(statepoint_file_path, tally_id, filter_indices, chunk_rows=65536) :
+    '''
+    Sums the mean of a tally over all nuclides, scores and other filters, once for each of the given
+    filters. The results dataset is read in contiguous chunks of rows, so memory use is set by
+    chunk_rows rather than by the size of the tally.
+
+    inputs :
+        statepoint_file_path : path to OpenMC Statepoint .h5 file
+        tally_id : id of the tally to read (int)
+        filter_indices : iterable of indices of filters within the tally's filters
+        chunk_rows : number of filter-bin rows of the results dataset read at once (int)
+    outputs :
+        filter_sums : list of 1-D numpy arrays of tally means along each of the filters
+    '''
+    with h5py.File(statepoint_file_path, 'r') as sp:
+        tally_group = sp['tallies'][f'tally {tally_id}']
+        n_realizations = tally_group['n_realizations'][()]
+        results = tally_group['results']
+        n_filter_bins = read_filter_bin_counts(sp, tally_group)
+        filter_sums = [np.zeros(n_filter_bins[filter_index]) for filter_index in filter_indices]
+        for start in range(0, results.shape[0], chunk_rows):
+            stop = min(start + chunk_rows, results.shape[0])
+            row_sums = results[start:stop, :, 0].sum(axis=1)
+            bin_indices = np.unravel_index(np.arange(start, stop), n_filter_bins)
+            for filter_sum, filter_index in zip(filter_sums, filter_indices):
+                filter_sum += np.bincount(bin_indices[filter_index], weights=row_sums, minlength=len(filter_sum))
+    return [filter_sum / n_realizations for filter_sum in filter_sums]
+
+def read_filter_bins(statepoint_file_path, tally_id, filter_index) :
+    '''
+    Reads the bins of one of a tally's filters directly from an OpenMC Statepoint file.
+
+    inputs :
+        statepoint_file_path : path to OpenMC Statepoint .h5 file
+        tally_id : id of the tally to read (int)
+        filter_index : index of the filter within the tally's filters
+    '''
+    with h5py.File(statepoint_file_path, 'r') as sp:
+        filter_id = sp['tallies'][f'tally {tally_id}']['filters'][filter_index]
+        bins = sp['tallies']['filters'][f'filter {filter_id}']['bins'][()]
+    return bins
+
+def read_filter_types(statepoint_file_path, tally_id) :
+    '''
+    Returns the types (str, e.g. 'mesh', 'energy', 'energyfunction') of a tally's filters, in the
+    order of the filter axes of read_tally_mean.
+    '''
+    with h5py.File(statepoint_file_path, 'r') as sp:
+        tally_group = sp['tallies'][f'tally {tally_id}']
+        filter_ids = tally_group['filters'][()] if tally_group['n_filters'][()] > 0 else []
+        filter_types = [sp['tallies']['filters'][f'filter {filter_id}']['type'][()].decode() for filter_id in filter_ids]
+    return filter_types
+
+def read_tally_scores(statepoint_file_path, tally_id) :
+    '''
+    Returns the scores (str) of a tally, in the order of the last axis of read_tally_mean.
+    '''
+    with h5py.File(statepoint_file_path, 'r') as sp:
+        scores = [score.decode() for score in sp['tallies'][f'tally {tally_id}']['score_bins'][()]]
+    return scores
+
+def read_mesh(statepoint_file_path, mesh_id) :
+    '''
+    Reads a single mesh from an OpenMC Statepoint file without loading its tallies.
+
+    inputs :
+        statepoint_file_path : path to OpenMC Statepoint .h5 file
+        mesh_id : id of the mesh (int), e.g. the bin of a mesh filter from read_filter_bins
+    outputs :
+        mesh : OpenMC Mesh object
+    '''
+    import openmc
+    with h5py.File(statepoint_file_path, 'r') as sp:
+        mesh = openmc.MeshBase.from_hdf5(sp['tallies']['meshes'][f'mesh {mesh_id}'])
+    return mesh
+
+def read_tally_ids(statepoint_file_path) :
+    '''
+    Returns the IDs (int) of all user tallies in an OpenMC Statepoint file.
+    Internal tallies (e.g. those OpenMC adds for depletion) store no results and are skipped.
+    '''
+    with h5py.File(statepoint_file_path, 'r') as sp:
+        tally_ids = [int(tally_id) for tally_id in sp['tallies'].attrs['ids']
+                     if not sp['tallies'][f'tally {tally_id}'].attrs.get('internal', 0)]
+    return tally_ids
@@ -0,0 +1,261 @@
+import openmc
+import openmc.deplete
+import openmc.mgxs
+from openmc.deplete.cram import CRAM48
+from openmc.deplete.reaction_rates import ReactionRates
+import numpy as np
+import scipy.sparse as sp
+import yaml
+import argparse
+import configparser
+import importlib
+import h5py
+from pymoab import core, types
+
+# The R2S script name is not a valid identifier, so it is imported by name
+r2s = importlib.import_module('OpenMC-to-ALARA_R2S')
+
+#Convert decay times from config.ini to seconds:
+
+# ALARA time units: seconds, minutes, hours, days, weeks, years and centuries
+time_unit_factors = {'s': 1.0, 'm': 60.0, 'h': 3600.0, 'd': 86400.0, 'w': 604800.0, 'y': 3.15576E+7, 'c': 3.15576E+9}
+
+def read_decay_times(config_fp):
+    '''
+    Reads the R2S Step 2 decay times from config.ini and converts them to seconds.
+    inputs:
+        config_fp: path to R2S config file (str)
+    outputs:
+        decay_times: list of decay times in [s] (float)
+    '''
+    config = configparser.ConfigParser()
+    config.read(config_fp)
+    decay_times = []
+    for decay_time in config['step2']['decay_times'].split(','):
+        value, unit = decay_time.split()
+        decay_times.append(float(value) * time_unit_factors[unit[0].lower()])
+    return decay_times
+
+#Read neutron fluxes and element geometry from the mesh:
+
+def read_mesh_fluxes(flux_mesh_file, flux_tag):
+    '''
+    Reads the group-wise neutron flux tag and element volumes from a MOAB tetrahedral mesh.
+    inputs:
+        flux_mesh_file: .h5m mesh file containing the neutron flux tag (str)
+        flux_tag: name of the flux tag on the Tet4 elements (str)
+    outputs:
+        fluxes: numpy array with rows = # of mesh elements and columns = # of neutron groups
+        volumes: numpy array of element volumes
+    '''
+    with h5py.File(flux_mesh_file, 'r') as mesh:
+        fluxes = mesh['tstt']['elements']['Tet4']['tags'][flux_tag][:]
+    vertices = r2s.read_element_vertices(flux_mesh_file)
+    edges = vertices[:, 1:, :] - vertices[:, :1, :]
+    volumes = np.abs(np.linalg.det(edges)) / 6.0
+    return fluxes, volumes
+
+#Build burnup matrices:
+
+def material_atom_densities(material):
+    '''
+    Creates a dictionary where keys = nuclide names (str) and values = number densities [atom/cm3]
+    inputs:
+        material: OpenMC Material object
+    '''
+    return {nuclide: atom_density * 1.0E+24 for nuclide, atom_density in material.get_nuclide_atom_densities().items()}
+
+def make_burnup_matrices(chain, spectrum, energies, temperature):
+    '''
+    Forms the decay matrix and the transmutation matrix per unit flux for one material.
+    inputs:
+        chain: OpenMC Chain object
+        spectrum: group-wise neutron flux used to collapse cross sections
+        energies: neutron group boundaries [eV] matching spectrum
+        temperature: temperature [K] at which cross sections are evaluated
+    outputs:
+        decay_matrix: scipy sparse matrix of decay constants [1/s]
+        reaction_matrix: scipy sparse matrix of reaction rates per unit flux [cm2]
+    '''
+    nuclides = [nuc.name for nuc in chain.nuclides]
+    reactions = list(chain.reactions)
+    micro_xs = openmc.deplete.MicroXS.from_multigroup_flux(energies, spectrum, temperature=temperature,
+                                                            nuclides=nuclides, reactions=reactions)
+    rates = ReactionRates(['0'], nuclides, reactions)
+    decay_matrix = chain.form_matrix(rates[0])
+    for nuc_index, nuclide in enumerate(micro_xs.nuclides):
+        for rx_index, reaction in enumerate(micro_xs.reactions):
+            # Convert barns to cm2 so rates are per unit flux [n/cm2-s]
+            rates[0, rates.index_nuc[nuclide], rates.index_rx[reaction]] = micro_xs.data[nuc_index, rx_index, 0] * 1.0E-24
+    reaction_matrix = chain.form_matrix(rates[0]) - decay_matrix
+    return decay_matrix.tocsr(), reaction_matrix.tocsr()
+
+#Solve for all mesh elements together:
+
+def activate_elements(decay_matrix, reaction_matrix, n0, scalar_fluxes, irradiation_time, decay_times):
+    '''
+    Irradiates a batch of mesh elements sharing one material and decays them to each
+    decay time. Irradiation solves the block-diagonal system of the whole batch with CRAM;
+    cooling is the same for every element, so it solves the single-material decay matrix
+    with one column of number densities per element.
+    inputs:
+        decay_matrix: scipy sparse matrix of decay constants [1/s]
+        reaction_matrix: scipy sparse matrix of reaction rates per unit flux [cm2]
+        n0: initial number densities [atom/cm3] in chain order
+        scalar_fluxes: total neutron flux [n/cm2-s] in each element of the batch
+        irradiation_time: length of irradiation [s]
+        decay_times: iterable of cooling times [s] after shutdown, in ascending order
+    outputs:
+        number_densities: numpy array indexed by decay time, element, nuclide
+    '''
+    # Each decay time is reached by decaying from the previous one
+    if np.any(np.diff(np.concatenate(([0.0], decay_times))) < 0.0):
+        raise ValueError(f"Decay times {list(decay_times)} [s] must be non-negative and in ascending order")
+    num_elements = len(scalar_fluxes)
+    identity = sp.identity(num_elements, format='csr')
+    irradiation_matrix = sp.kron(identity, decay_matrix) + sp.kron(sp.diags(scalar_fluxes), reaction_matrix)
+    n = CRAM48(irradiation_matrix.tocsr(), np.tile(n0, num_elements), irradiation_time)
+    # Columns = elements, so each pole of the decay matrix is factorized once for the whole batch
+    n = n.reshape(num_elements, -1).T
+    number_densities = []
+    previous_time = 0.0
+    for decay_time in decay_times:
+        n = CRAM48(decay_matrix, n, decay_time - previous_time)
+        number_densities.append(n.T)
+        previous_time = decay_time
+    return np.array(number_densities)
+
+#Convert nuclide inventories to photon sources:
+
+def group_photon_intensities(dist, bounds):
+    '''
+    Integrates a decay photon energy distribution over each photon group.
+    inputs:
+        dist: OpenMC Univariate distribution with intensities in [photons/s-atom]
+        bounds: iterable of photon energy bounds (float)
+    '''
+    if isinstance(dist, openmc.stats.Mixture):
+        return sum(prob * group_photon_intensities(sub_dist, bounds) for prob, sub_dist in zip(dist.probability, dist.distribution))
+    if isinstance(dist, openmc.stats.Discrete):
+        return np.histogram(dist.x, bins=bounds, weights=dist.p)[0]
+    if dist.interpolation == 'histogram':
+        cdf = np.concatenate(([0.0], np.cumsum(dist.p[:-1] * np.diff(dist.x))))
+    else:
+        cdf = np.concatenate(([0.0], np.cumsum(0.5 * (dist.p[:-1] + dist.p[1:]) * np.diff(dist.x))))
+    return np.diff(np.interp(bounds, dist.x, cdf))
+
+def make_photon_emission_matrix(chain, bounds):
+    '''
+    Creates a numpy array with rows = nuclides in chain order and columns = photon groups,
+    holding the decay photon emission rate of each nuclide [photons/s-atom].
+    '''
+    emission = np.zeros((len(chain.nuclides), len(bounds) - 1))
+    for nuc_index, nuc in enumerate(chain.nuclides):
+        dist = openmc.data.decay_photon_energy(nuc.name)
+        if dist is not None:
+            emission[nuc_index] = group_photon_intensities(dist, bounds)
+    return emission
+
+def write_source_meshes(mesh_file, source_densities, output_prefix):
+    '''
+    Writes one .h5m file per decay time with a source_density tag on the Tet4 elements,
+    in the same layout as R2S Step 2 output.
+    inputs:
+        mesh_file: tetrahedral mesh file onto which the photon source is written
+        source_densities: numpy array indexed by decay time, element, photon group [photons/cm3-s]
+        output_prefix: prefix of the source mesh file names (str)
+    outputs:
+        source_mesh_list: list of source mesh file names (str)
+    '''
+    source_mesh_list = []
+    for decay_index, source_density in enumerate(source_densities):
+        mb = core.Core()
+        mb.load_file(mesh_file)
+        all_tets = mb.get_entities_by_type(0, types.MBTET)
+        sd_tag = mb.tag_get_handle('source_density', source_density.shape[1], types.MB_TYPE_DOUBLE, types.MB_TAG_DENSE, create_if_missing=True)
+        mb.tag_set_data(sd_tag, all_tets, source_density)
+        source_mesh = f"{output_prefix}_{decay_index + 1}.h5m"
+        mb.write_file(source_mesh)
+        source_mesh_list.append(source_mesh)
+    return source_mesh_list
+
+#--------------
+#Execute all functions:
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--yaml_filepath', default = 'OpenMC_ALARA_WC.yaml', help="Path to YAML file containing required inputs for OpenMC-ALARA R2S workflow (str)")
+    args = parser.parse_args()
+    return args
+
+def read_yaml(args):
+    with open(args.yaml_filepath, 'r') as file:
+        inputs = yaml.safe_load(file)
+    return inputs
+
+def run_mesh_activation(inputs):
+    '''
+    Activates every mesh element and writes its photon source densities at each decay time.
+    Cross sections are collapsed once per material with the spectrum summed over all of its
+    elements, so elements of one layer share a single set of reaction rates per unit flux and
+    differ only in their total flux. Spectral shifts across a layer (e.g. softening with depth)
+    are not resolved, which is acceptable for design screening but not for final results.
+    inputs:
+        inputs: dictionary of model and activation inputs read from OpenMC_ALARA_WC.yaml
+    '''
+    act_info = inputs['activation_info']
+    geom_info = inputs['geom_info']
+    openmc.config['chain_file'] = act_info['chain_file']
+    config = configparser.ConfigParser()
+    config.read(act_info['config_file'])
+
+    decay_times = read_decay_times(act_info['config_file'])
+    tally_fluxes, volumes = read_mesh_fluxes(config['step1']['meshtal'], config['step1']['flux_tag'])
+    # Tally fluxes are per source particle; convert to flux density [n/cm2-s]
+    fluxes = tally_fluxes / volumes[:, np.newaxis] * act_info['source_rate']
+    materials = r2s.create_materials_obj(inputs)
+    geometry = r2s.create_geometry_obj(materials, inputs)
+    element_cell_ids, element_material_ids, element_overlaps = r2s.make_element_cell_index(inputs['filename_dict']['mesh_file'],
+                    inputs['filename_dict']['cell_index_file'],
+                    geometry,
+                    geom_info['inner_radius'],
+                    geom_info['thicknesses'])
+    if len(element_material_ids) != len(fluxes):
+        raise ValueError(f"{config['step1']['meshtal']} has {len(fluxes)} elements but the cell index of "
+                         f"{inputs['filename_dict']['mesh_file']} has {len(element_material_ids)}")
+    energies = openmc.mgxs.GROUP_STRUCTURES['VITAMIN-J-175']
+    bounds = inputs['source_info']['phtn_e_bounds']
+
+    full_chain = openmc.deplete.Chain.from_xml(act_info['chain_file'])
+
+    source_densities = np.zeros((len(decay_times), len(fluxes), len(bounds) - 1))
+    for material in materials:
+        in_layer = np.flatnonzero(element_material_ids == material.id)
+        if len(in_layer) == 0:
+            continue
+        n0_dict = material_atom_densities(material)
+        chain = full_chain.reduce(list(n0_dict))
+        n0 = np.array([n0_dict.get(nuc.name, 0.0) for nuc in chain.nuclides])
+        # Tally fluxes are volume-integrated, so their sum is the volume-weighted spectrum of the material
+        decay_matrix, reaction_matrix = make_burnup_matrices(chain,
+                        tally_fluxes[in_layer].sum(axis=0),
+                        energies,
+                        act_info['temperature'])
+        emission = make_photon_emission_matrix(chain, bounds)
+        for start in range(0, len(in_layer), act_info['batch_size']):
+            batch = in_layer[start:start + act_info['batch_size']]
+            number_densities = activate_elements(decay_matrix, reaction_matrix, n0,
+                        fluxes[batch].sum(axis=1),
+                        act_info['irradiation_time'],
+                        decay_times)
+            source_densities[:, batch, :] = number_densities @ emission
+
+    write_source_meshes(config['step1']['meshtal'], source_densities, config['step2']['output'])
+
+def main():
+    args = parse_args()
+    inputs = read_yaml(args)
+    run_mesh_activation(inputs)
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ import numpy as np
 import yaml
 import argparse
 import h5py
+import os
+import glob
 
 #Set up materials for model:
 
@@ -68,8 +70,10 @@ def make_neutron_source(energy):
     source = openmc.Source(space = point_source, energy = energy_dist, strength = 1.0, particle = 'neutron')
     return source
 
-def make_neutron_tallies(mesh_file):
-    mesh_filter = openmc.MeshFilter(openmc.UnstructuredMesh(mesh_file, library='moab'))
+def make_neutron_tallies(mesh_file, unstructured_mesh=None):
+    if unstructured_mesh is None:
+        unstructured_mesh = openmc.UnstructuredMesh(mesh_file, library='moab')
+    mesh_filter = openmc.MeshFilter(unstructured_mesh)
     particle_filter = openmc.ParticleFilter('neutron')
     energy_filter_flux = openmc.EnergyFilter.from_group_structure("VITAMIN-J-175")
     
@@ -99,15 +103,157 @@ def extract_photon_source_data(source_mesh_list, num_elements, num_photon_groups
          sd_list[source_index,:] = file['tstt']['elements']['Tet4']['tags']['source_density'][:]
     return sd_list   
     
-def make_photon_sources(bounds, cells, mesh_file, source_mesh_index, sd_list):
+#Map mesh elements to geometry cells:
+
+def read_element_vertices(mesh_file):
+    '''
+    Reads the vertex coordinates of each tetrahedral element of a MOAB mesh.
+    
+    input:
+        mesh_file: .h5/.h5m MOAB mesh file (str)
+    output:
+        numpy array of vertex coordinates indexed by mesh element, vertex, coordinate
+    '''
+    with h5py.File(mesh_file, 'r') as mesh:
+        connectivity = mesh['tstt']['elements']['Tet4']['connectivity'][:]
+        node_coords = mesh['tstt']['nodes']['coordinates']
+        # connectivity is stored as uint64 and start_id as int64, whose difference numpy promotes to float64
+        vertices = node_coords[:][connectivity.astype(np.int64) - int(node_coords.attrs['start_id'])]
+    return vertices
+
+def segment_min_radius(start, end):
+    '''
+    Returns the distance from the origin to the closest point of each line segment.
+    
+    inputs:
+        start, end: numpy arrays of segment end point coordinates, with coordinates along the last axis
+    '''
+    direction = end - start
+    fraction = np.clip(-np.sum(start * direction, axis=-1) / np.sum(direction * direction, axis=-1), 0.0, 1.0)
+    return np.linalg.norm(start + fraction[..., np.newaxis] * direction, axis=-1)
+
+def element_radial_extents(vertices):
+    '''
+    Returns the smallest and largest distance from the origin of any point in each tetrahedral element.
+    The largest is attained at a vertex. The smallest is attained on a face, either at the projection of 
+    the origin onto the face plane, if it falls inside the face, or on one of the face edges; it is 0 for
+    elements containing the origin.
+    
+    inputs:
+        vertices: numpy array of vertex coordinates from read_element_vertices
+    outputs:
+        min_radii: numpy array of the smallest radius in each element
+        max_radii: numpy array of the largest radius in each element
+    '''
+    max_radii = np.linalg.norm(vertices, axis=2).max(axis=1)
+    min_radii = np.full(len(vertices), np.inf)
+    contains_origin = np.ones(len(vertices), dtype=bool)
+    for face, opposite in (((0, 1, 2), 3), ((0, 1, 3), 2), ((0, 2, 3), 1), ((1, 2, 3), 0)):
+        a, b, c = (vertices[:, vertex, :] for vertex in face)
+        normal = np.cross(b - a, c - a)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            projection = (np.sum(a * normal, axis=1) / np.sum(normal * normal, axis=1))[:, np.newaxis] * normal
+        in_face = np.ones(len(vertices), dtype=bool)
+        for edge_start, edge_end in ((a, b), (b, c), (c, a)):
+            in_face &= np.sum(np.cross(edge_end - edge_start, projection - edge_start) * normal, axis=1) >= 0.0
+            min_radii = np.minimum(min_radii, segment_min_radius(edge_start, edge_end))
+        min_radii = np.where(in_face, np.minimum(min_radii, np.linalg.norm(projection, axis=1)), min_radii)
+        # The origin is inside the element if it is on the same side of every face as the opposite vertex
+        contains_origin &= np.sum(-a * normal, axis=1) * np.sum((vertices[:, opposite, :] - a) * normal, axis=1) >= 0.0
+    return np.where(contains_origin, 0.0, min_radii), max_radii
+
+def check_spherical_shells(geometry, inner_radius, thicknesses):
+    '''
+    Raises a ValueError unless the geometry is the set of concentric shells built by make_spherical_shells
+    for the given radii, which is the only geometry the element cell index can locate elements in.
+    
+    inputs:
+        geometry: OpenMC Geometry object
+        inner_radius: the radius of the innermost spherical shell
+        thicknesses: iterable of shell thicknesses (float)
+    '''
+    radii = inner_radius + np.cumsum(np.concatenate(([0.0], thicknesses)))
+    surfaces = list(geometry.get_all_surfaces().values())
+    sphere_radii = sorted(surface.r for surface in surfaces 
+                          if isinstance(surface, openmc.Sphere) and (surface.x0, surface.y0, surface.z0) == (0.0, 0.0, 0.0))
+    if (len(sphere_radii) != len(surfaces) or len(sphere_radii) != len(radii) 
+            or not np.allclose(sphere_radii, radii) or len(geometry.get_all_cells()) != len(radii) + 1):
+        raise ValueError("The element cell index only supports the concentric spherical shells built by "
+                         "make_spherical_shells from geom_info; other geometries need a point-location index")
+
+def locate_spherical_shells(vertices, geometry, inner_radius, thicknesses):
+    '''
+    Identifies the cell containing each element centroid, and every cell each element may overlap, for
+    the concentric shells built by make_spherical_shells, whose cells run radially outward from the
+    inner void to the outer void.
+    An element overlaps every cell between those containing its smallest and largest radius.
+    
+    inputs:
+        vertices: numpy array of vertex coordinates from read_element_vertices
+        geometry: OpenMC Geometry object from make_spherical_shells
+        inner_radius: the radius of the innermost spherical shell
+        thicknesses: iterable of shell thicknesses (float)
+    outputs:
+        element_cell_ids: numpy array of cell IDs (int), one per mesh element
+        element_overlaps: boolean numpy array with rows = mesh elements and columns = cells 
+            in the order of geometry.get_all_cells()
+    '''
+    radii = inner_radius + np.cumsum(np.concatenate(([0.0], thicknesses)))
+    cell_ids = np.array(list(geometry.get_all_cells()))
+    centroids = vertices.mean(axis=1)
+    centroid_radii = np.linalg.norm(centroids, axis=1)
+    element_cell_ids = cell_ids[np.digitize(centroid_radii, radii)]
+    min_radii, max_radii = element_radial_extents(vertices)
+    innermost_cell = np.digitize(min_radii, radii)
+    outermost_cell = np.digitize(max_radii, radii)
+    cell_indices = np.arange(len(cell_ids))
+    element_overlaps = (innermost_cell[:, np.newaxis] <= cell_indices) & (cell_indices <= outermost_cell[:, np.newaxis])
+    return element_cell_ids, element_overlaps
+
+def make_element_cell_index(mesh_file, index_file, geometry, inner_radius, thicknesses):
+    '''
+    Maps each mesh element to its geometry cell and material, and to every cell it may overlap, 
+    caching the result in an .npz file. The cache is reused while it is newer than the mesh and 
+    was built for the same shell radii.
+    
+    inputs:
+        mesh_file: .h5/.h5m MOAB mesh file (str)
+        index_file: .npz file in which the index is cached (str)
+        geometry: OpenMC Geometry object from make_spherical_shells
+        inner_radius: the radius of the innermost spherical shell
+        thicknesses: iterable of shell thicknesses (float)
+    outputs:
+        element_cell_ids: numpy array of cell IDs (int) containing each element centroid
+        element_material_ids: numpy array of material IDs (int) containing each element centroid, 0 for void
+        element_overlaps: boolean numpy array with rows = mesh elements and columns = cells 
+            in the order of geometry.get_all_cells(), True where the element may overlap the cell
+    '''
+    check_spherical_shells(geometry, inner_radius, thicknesses)
+    radii = inner_radius + np.cumsum(np.concatenate(([0.0], thicknesses)))
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(mesh_file):
+        cached_index = np.load(index_file)
+        if 'overlaps' in cached_index.files and np.array_equal(cached_index['radii'], radii):
+            return cached_index['cell_ids'], cached_index['material_ids'], cached_index['overlaps']
+    element_cell_ids, element_overlaps = locate_spherical_shells(read_element_vertices(mesh_file), geometry, inner_radius, thicknesses)
+    cells = geometry.get_all_cells()
+    cell_material_ids = {cell_id: cell.fill.id if cell.fill is not None else 0 for cell_id, cell in cells.items()}
+    element_material_ids = np.array([cell_material_ids[cell_id] for cell_id in element_cell_ids])
+    np.savez(index_file, cell_ids=element_cell_ids, material_ids=element_material_ids, overlaps=element_overlaps, radii=radii)
+    return element_cell_ids, element_material_ids, element_overlaps
+
+def make_photon_sources(bounds, element_in_material, source_cells, mesh_file, source_mesh_index, sd_list, unstructured_mesh=None):
     '''
-    Creates a list of OpenMC sources, complete with the relevant space and energy distributions
+    Creates a list of OpenMC sources, complete with the relevant space and energy distributions.
+    Sites are restricted to the material cells by domain rejection. Elements that lie wholly in void
+    are given zero strength, so rejection only occurs in elements straddling a void boundary.
     
     inputs:
         bounds : iterable of photon energy bounds (float)
-        cells: list of OpenMC Cell objects
+        element_in_material: boolean numpy array, True for mesh elements that may overlap a material cell
+        source_cells: list of OpenMC Cell objects filled with material
         mesh_file: .h5/.h5m mesh onto which photon source will be distributed
         source_mesh_index: index specifying the photon source from which data is extracted
+        unstructured_mesh: OpenMC Unstructured Mesh object of mesh_file to reuse, created if not given
         
     output:
         source_list: list of OpenMC independent sources
@@ -115,22 +261,28 @@ def make_photon_sources(bounds, cells, mesh_file, source_mesh_index, sd_list):
     '''
 
     source_list = []
-    unstructured_mesh = openmc.UnstructuredMesh(mesh_file, library='moab')
+    if unstructured_mesh is None:
+        unstructured_mesh = openmc.UnstructuredMesh(mesh_file, library='moab')
     for index, (lower_bound, upper_bound) in enumerate(zip(bounds[:-1],bounds[1:])):
-        mesh_dist = openmc.stats.MeshSpatial(unstructured_mesh, strengths=sd_list[source_mesh_index][:,index], volume_normalized=False)
+        strengths = sd_list[source_mesh_index][:,index] * element_in_material
+        mesh_dist = openmc.stats.MeshSpatial(unstructured_mesh, strengths=strengths, volume_normalized=False)
         energy_dist = openmc.stats.Uniform(a=lower_bound, b=upper_bound)
-        source_list.append(openmc.IndependentSource(space=mesh_dist, energy=energy_dist, strength=np.sum(sd_list[source_mesh_index][:, index]), particle='photon', domains=cells))
+        source_list.append(openmc.IndependentSource(space=mesh_dist, energy=energy_dist, strength=np.sum(strengths), particle='photon', domains=source_cells))
     return source_list, unstructured_mesh
 
-def make_photon_tallies(unstructured_mesh, tallied_cells, coeff_geom, bounds):
+def make_photon_tallies(unstructured_mesh, tallied_cells, coeff_geom, bounds, element_overlaps, index_cell_ids):
     '''
     Creates tallies and assigns energy, spatial, and particle filters.
+    The flux spectrum is tallied on the mesh and by cell in separate tallies where every
+    mesh element lies wholly within the tallied cells (see optimize_tally_layout).
     
     inputs: 
         unstructured_mesh: OpenMC unstructured mesh object
         tallied_cells: OpenMC Cell/iterable of OpenMC Cell objects/iterable of Cell ID #
         coeff_geom : irradation geometry associated with dose coefficient calculation
         bounds : energy bounds associated with photon source from ALARA
+        element_overlaps: boolean numpy array of the cells each mesh element may overlap, from make_element_cell_index
+        index_cell_ids: iterable of cell IDs (int) of the columns of element_overlaps
         
     outputs:
         talls: OpenMC Tallies object
@@ -157,9 +309,75 @@ def make_photon_tallies(unstructured_mesh, tallied_cells, coeff_geom, bounds):
     spectrum_tally.filters = [cell_filter, mesh_filter, energy_filter_flux, particle_filter, dose_filter] ##
     spectrum_tally.scores = ['flux']
     
-    talls = openmc.Tallies([photon_tally, spectrum_tally])
+    talls = optimize_tally_layout(openmc.Tallies([photon_tally, spectrum_tally]), element_overlaps, index_cell_ids)
     return talls
 
+def filter_num_bins(tally_filter, num_elements):
+    '''
+    Returns the number of bins of a tally filter.
+    
+    inputs:
+        tally_filter: OpenMC Filter object
+        num_elements: number of elements in the unstructured mesh (int), which is not known to
+            an OpenMC UnstructuredMesh object until the mesh is loaded
+    '''
+    if isinstance(tally_filter, openmc.MeshFilter):
+        return num_elements
+    return tally_filter.num_bins
+
+def tally_size(tally, num_elements):
+    '''
+    Returns the number of result bins of a tally and the memory [bytes] OpenMC allocates for them,
+    which holds the value, sum and sum of squares of every bin as doubles.
+    '''
+    num_bins = int(np.prod([filter_num_bins(tally_filter, num_elements) for tally_filter in tally.filters]))
+    num_bins *= max(len(tally.nuclides), 1) * len(tally.scores)
+    return num_bins, num_bins * 3 * 8
+
+def optimize_tally_layout(talls, element_overlaps, index_cell_ids):
+    '''
+    Splits every tally that combines a CellFilter with a MeshFilter into a mesh tally without
+    the cell filter and a cell tally without the mesh filter. Each mesh element lies in a single
+    cell, so all but one cell bin per element of the combined tally are empty.
+    Dropping the cell filter from the mesh tally is only equivalent if every element lies wholly
+    within its cells; otherwise particle tracks in the parts of elements in other (e.g. void) cells
+    would be scored, so tallies with any element that may overlap another cell are left unchanged.
+    Prints the bin count and memory of the tallies before and after the change.
+    
+    inputs:
+        talls: OpenMC Tallies object
+        element_overlaps: boolean numpy array of the cells each mesh element may overlap, from make_element_cell_index
+        index_cell_ids: iterable of cell IDs (int) of the columns of element_overlaps
+    outputs:
+        optimized_talls: OpenMC Tallies object
+    '''
+    num_elements = len(element_overlaps)
+    bins_before, memory_before = np.sum([tally_size(tally, num_elements) for tally in talls], axis=0)
+    optimized_talls = openmc.Tallies()
+    next_tally_id = max(tally.id for tally in talls) + 1
+    for tally in talls:
+        optimized_talls.append(tally)
+        cell_filters = [tally_filter for tally_filter in tally.filters if isinstance(tally_filter, openmc.CellFilter)]
+        has_mesh_filter = any(isinstance(tally_filter, openmc.MeshFilter) for tally_filter in tally.filters)
+        if not (cell_filters and has_mesh_filter):
+            continue
+        untallied_columns = ~np.isin(index_cell_ids, cell_filters[0].bins)
+        untallied = element_overlaps[:, untallied_columns].any(axis=1)
+        if untallied.any():
+            print(f"{tally.name}: {np.count_nonzero(untallied)} mesh elements extend outside the tallied cells, keeping the cell filter on the mesh tally")
+            continue
+        cell_tally = openmc.Tally(tally_id=next_tally_id, name=f"{tally.name} by cell")
+        cell_tally.filters = [tally_filter for tally_filter in tally.filters if not isinstance(tally_filter, openmc.MeshFilter)]
+        cell_tally.nuclides = tally.nuclides
+        cell_tally.scores = tally.scores
+        tally.filters = [tally_filter for tally_filter in tally.filters if not isinstance(tally_filter, openmc.CellFilter)]
+        optimized_talls.append(cell_tally)
+        next_tally_id += 1
+    bins_after, memory_after = np.sum([tally_size(tally, num_elements) for tally in optimized_talls], axis=0)
+    print(f"Tally bins: {bins_before} before, {bins_after} after optimizing the layout")
+    print(f"Tally memory: {memory_before/1.0E+6:.2f} MB before, {memory_after/1.0E+6:.2f} MB after optimizing the layout")
+    return optimized_talls
+
 def make_settings(source_list, tot_batches, inactive_batches, num_particles, run_mode):
     '''
     Creates an OpenMC Settings object
@@ -177,6 +395,179 @@ def make_settings(source_list, tot_batches, inactive_batches, num_particles, run
     sets.run_mode = run_mode
     return sets
 
+#Run the neutron and photon problems in one OpenMC session:
+
+def make_stage_time(stage_index, stage_duration):
+    '''
+    Creates the source time distribution that tags the particles of one in-process stage
+    (stage 0 = neutron transport, stage k = photon transport for decay time k).
+    
+    inputs:
+        stage_index: index of the stage (int)
+        stage_duration: time offset [s] between consecutive stages (float)
+    '''
+    return openmc.stats.Discrete([stage_index * stage_duration], [1.0])
+
+def find_checkpoint(total_batches, output_dir):
+    '''
+    Returns the statepoint file of the latest batch written to output_dir by a previous
+    in-process run and that batch number, or (None, 0) if there is none.
+    
+    inputs:
+        total_batches: total number of batches of the run (int)
+        output_dir: directory holding the statepoint files of in-process runs (str)
+    '''
+    checkpoints = {}
+    for statepoint_filename in glob.glob(os.path.join(output_dir, "statepoint.*.h5")):
+        batch = os.path.basename(statepoint_filename).split('.')[1]
+        if batch.isdigit() and int(batch) <= total_batches:
+            checkpoints[int(batch)] = statepoint_filename
+    if not checkpoints:
+        return None, 0
+    return checkpoints[max(checkpoints)], max(checkpoints)
+
+def check_checkpoint(statepoint_filename, model, photon_tally_ids):
+    '''
+    Raises a ValueError unless a statepoint file was written by a run of this in-process model,
+    i.e. with the same batches, particles, tally IDs and filter types, and the same stage TimeFilter
+    leading every photon tally.
+    
+    inputs:
+        statepoint_filename: path to OpenMC Statepoint file (str)
+        model: OpenMC Model object from create_in_process_model
+        photon_tally_ids: iterable of IDs (int) of the time-filtered photon tallies
+    '''
+    model_tallies = {tally.id: tally for tally in model.tallies}
+    mismatches = []
+    with h5py.File(statepoint_filename, 'r') as sp:
+        if int(sp['n_batches'][()]) != model.settings.batches:
+            mismatches.append('batches')
+        if int(sp['n_particles'][()]) != model.settings.particles:
+            mismatches.append('particles')
+        tallies = sp['tallies']
+        sp_tally_ids = {int(tally_id) for tally_id in tallies.attrs.get('ids', [])
+                        if not tallies[f'tally {tally_id}'].attrs.get('internal', 0)}
+        if sp_tally_ids != set(model_tallies):
+            mismatches.append('tally IDs')
+        else:
+            for tally_id, tally in model_tallies.items():
+                tally_group = tallies[f'tally {tally_id}']
+                filter_ids = tally_group['filters'][()] if tally_group['n_filters'][()] > 0 else []
+                filter_types = [tallies[f'filters/filter {filter_id}/type'][()].decode() for filter_id in filter_ids]
+                if filter_types != [tally_filter.short_name.lower() for tally_filter in tally.filters]:
+                    mismatches.append(f'filters of tally {tally_id}')
+                elif tally_id in photon_tally_ids:
+                    time_bins = tallies[f'filters/filter {filter_ids[0]}/bins'][()]
+                    if not np.array_equal(time_bins, tally.filters[0].values):
+                        mismatches.append(f'stage TimeFilter of tally {tally_id}')
+    if mismatches:
+        raise ValueError(f"{statepoint_filename} was not written by this in-process model "
+                         f"(different {', '.join(mismatches)}); remove it or run without --restart")
+
+def load_tally_means(statepoint_filename):
+    '''
+    Reads the tally means of a completed run back from its statepoint file, in the same
+    layout as openmc.lib tally means (rows = # of filter bins, columns = # of nuclides x # of scores).
+    
+    inputs:
+        statepoint_filename: path to OpenMC Statepoint file (str)
+    outputs:
+        tally_means: dictionary with keys = tally ID (int) and values = numpy array of tally means
+    '''
+    with openmc.StatePoint(statepoint_filename) as sp:
+        tally_means = {tally_id: tally.mean.reshape(tally.mean.shape[0], -1) for tally_id, tally in sp.tallies.items()}
+    return tally_means
+
+def split_stage_means(tally_means, photon_tally_ids, num_decay_times):
+    '''
+    Separates the tally means of a combined in-process run into the neutron stage and one
+    set of photon tallies per decay time, each normalised per source particle of its own stage.
+    
+    inputs:
+        tally_means: dictionary with keys = tally ID (int) and values = numpy array of tally means
+            with rows = # of filter bins and columns = # of nuclides x # of scores
+        photon_tally_ids: iterable of IDs (int) of the photon tallies, whose first filter is the stage TimeFilter
+        num_decay_times: number of decay times (int)
+    outputs:
+        neutron_means: dictionary of neutron tally means keyed by tally ID
+        photon_means: list of dictionaries of photon tally means keyed by tally ID, one per decay time
+    '''
+    # Every stage holds an equal share of the total source strength
+    num_stages = num_decay_times + 1
+    neutron_means = {tally_id: mean * num_stages for tally_id, mean in tally_means.items() if tally_id not in photon_tally_ids}
+    photon_means = [{} for decay_index in range(num_decay_times)]
+    for tally_id in photon_tally_ids:
+        stage_means = tally_means[tally_id].reshape(num_decay_times, -1, tally_means[tally_id].shape[-1])
+        for decay_index in range(num_decay_times):
+            photon_means[decay_index][tally_id] = stage_means[decay_index] * num_stages
+    return neutron_means, photon_means
+
+def report_prompt_photons(events_means):
+    '''
+    Prints the photon tally events of the neutron stage, which come from prompt photons that are
+    transported only to be discarded by the photon tally TimeFilter, relative to those of all stages.
+    
+    inputs:
+        events_means: numpy array of the means of the stage events tally, one row per stage
+    '''
+    stage_events = np.ravel(events_means)
+    total_events = stage_events.sum()
+    prompt_fraction = stage_events[0] / total_events if total_events > 0 else 0.0
+    print(f"Prompt photons of the neutron stage: {stage_events[0]:.3e} tally events per source particle, "
+          f"{prompt_fraction:.1%} of all photon tally events")
+
+def run_r2s_in_process(model, photon_tally_ids, events_tally_id, num_decay_times, output_dir, threads=None, restart=False, checkpoint_interval=None):
+    '''
+    Runs the combined neutron and photon model from create_in_process_model through openmc.lib,
+    initialising OpenMC (cross sections, geometry and unstructured mesh) a single time.
+    
+    The statepoint files of the run are written to output_dir rather than the working directory. They
+    hold the combined tallies of every stage, normalised per particle of the whole run, so they are
+    only checkpoints for restarts; the per-stage results are those returned (and saved by save_stage_means).
+    
+    inputs:
+        model: OpenMC Model object from create_in_process_model
+        photon_tally_ids: iterable of IDs (int) of the time-filtered photon tallies
+        events_tally_id: ID (int) of the stage events tally, reported by report_prompt_photons
+        num_decay_times: number of decay times (int)
+        output_dir: directory for the statepoint and summary files of the run (str)
+        threads: number of OpenMC threads (int), defaults to the OpenMC default
+        restart: continue from the latest statepoint in output_dir, once check_checkpoint accepts it (bool)
+        checkpoint_interval: number of batches between statepoint files (int), only the final batch if None
+    outputs:
+        neutron_means: dictionary of neutron tally means keyed by tally ID
+        photon_means: list of dictionaries of photon tally means keyed by tally ID, one per decay time
+    '''
+    import openmc.lib
+    total_batches = model.settings.batches
+    os.makedirs(output_dir, exist_ok=True)
+    model.settings.output = {'path': output_dir}
+    if checkpoint_interval is not None:
+        model.settings.statepoint = {'batches': list(range(checkpoint_interval, total_batches, checkpoint_interval)) + [total_batches]}
+    restart_file, restart_batch = find_checkpoint(total_batches, output_dir) if restart else (None, 0)
+    if restart_file is not None:
+        check_checkpoint(restart_file, model, photon_tally_ids)
+    if restart_batch == total_batches:
+        # The run already finished; there are no batches left to simulate
+        tally_means = load_tally_means(restart_file)
+    else:
+        model.init_lib(threads=threads, output=False, restart_file=restart_file)
+        openmc.lib.run(output=False)
+        tally_means = {tally_id: tally.mean.copy() for tally_id, tally in openmc.lib.tallies.items()}
+        model.finalize_lib()
+    report_prompt_photons(tally_means.pop(events_tally_id))
+    return split_stage_means(tally_means, photon_tally_ids, num_decay_times)
+
+def save_stage_means(neutron_means, photon_means, filename):
+    '''
+    Saves the tally means of every in-process stage to a single .npz file, with keys
+    neutron_tally_<ID> and photon_<decay time index>_tally_<ID>.
+    '''
+    arrays = {f"neutron_tally_{tally_id}": mean for tally_id, mean in neutron_means.items()}
+    for decay_index, decay_means in enumerate(photon_means):
+        arrays.update({f"photon_{decay_index + 1}_tally_{tally_id}": mean for tally_id, mean in decay_means.items()})
+    np.savez(filename, **arrays)
+
 #--------------
 #Execute all functions:
 
@@ -185,6 +576,24 @@ def parse_args():
     parser.add_argument('--yaml_filepath', default = 'OpenMC_ALARA_WC.yaml', help="Path to YAML file containing required inputs for OpenMC-ALARA R2S workflow (str)")
     parser.add_argument("--neutron_transport", default=True, help="Create neutron transport model")
     parser.add_argument("--photon_transport", default=True, help="Create photon transport model")
+    parser.add_argument(
+        '--in_process',
+        default = 'False',
+        choices=['True', 'False'],
+        help='Run neutron and photon transport for every decay time in one openmc.lib session instead of exporting model XML files. '
+             'Per-stage tally means are saved only to --in_process_results; the statepoints in --in_process_dir are combined, '
+             'unnormalised checkpoints. Prompt photons of the neutron stage are also transported; their share of photon work is printed',
+        )
+    parser.add_argument(
+        '--restart',
+        default = 'False',
+        choices=['True', 'False'],
+        help='Continue an in-process run from the latest statepoint in --in_process_dir',
+        )
+    parser.add_argument('--threads', default=None, type=int, help="Number of OpenMC threads used for in-process runs (int)")
+    parser.add_argument('--checkpoint_interval', default=None, type=int, help="Number of batches between statepoint files of in-process runs (int)")
+    parser.add_argument('--in_process_dir', default='in_process_checkpoints', help="Directory for the statepoint and summary files of in-process runs (str)")
+    parser.add_argument('--in_process_results', default='in_process_tallies.npz', help="Path to .npz file in which in-process tally means are saved (str)")
     args = parser.parse_args()
     return args
    
@@ -238,10 +647,18 @@ def read_source_mesh(inputs):
 
 def create_photon_model(inputs, materials, geometry, sd_list):
     settings_info = inputs['settings_info']                                            
-    cells = list(geometry.get_all_cells().values())
+    geom_info = inputs['geom_info']
     tallied_cells = list(geometry.get_all_material_cells().values())
+    element_cell_ids, element_material_ids, element_overlaps = make_element_cell_index(inputs['filename_dict']['mesh_file'],
+                inputs['filename_dict']['cell_index_file'],
+                geometry,
+                geom_info['inner_radius'],
+                geom_info['thicknesses'])
+    material_columns = [cell.fill is not None for cell in geometry.get_all_cells().values()]
+    element_in_material = element_overlaps[:, material_columns].any(axis=1)
     source_list, unstructured_mesh = make_photon_sources(inputs['source_info']['phtn_e_bounds'],
-                cells, 
+                element_in_material, 
+                tallied_cells,
                 inputs['filename_dict']['mesh_file'], 
                 inputs['file_indices']['source_mesh_index'], 
                 sd_list)
@@ -250,16 +667,104 @@ def create_photon_model(inputs, materials, geometry, sd_list):
                 settings_info['inactive_batches'], 
                 settings_info['num_particles'], 
                 settings_info['run_mode'])
-    photon_tallies = make_photon_tallies(unstructured_mesh, tallied_cells, inputs['coeff_geom'], inputs['source_info']['phtn_e_bounds'])
+    photon_tallies = make_photon_tallies(unstructured_mesh, tallied_cells, inputs['coeff_geom'], inputs['source_info']['phtn_e_bounds'], element_overlaps, list(geometry.get_all_cells()))
     photon_model = openmc.model.Model(geometry = geometry, materials = materials, settings = photon_settings, tallies = photon_tallies) 
     return photon_model                             
 
+#Build combined model for in-process execution:
+
+def create_in_process_model(inputs, materials, geometry, sd_list, stage_duration=1.0):
+    '''
+    Creates one OpenMC model holding the neutron problem and the photon problem of every decay time,
+    so that a single OpenMC initialisation serves all of them.
+    
+    The sources of each stage are emitted at their own time (see make_stage_time) and scaled to a total
+    strength of 1, so every stage receives an equal share of the particles. The photon tallies carry a
+    TimeFilter with one bin per decay time, which separates the decay times and keeps prompt photons
+    from the neutron stage out of the photon results.
+    
+    Photon transport is on for the whole run, so unlike the separate neutron model the neutron stage 
+    also transports its prompt (capture and inelastic) photons, only for the TimeFilter to discard them.
+    A photon events tally with one bin per stage measures that extra work, and run_r2s_in_process
+    reports it (see report_prompt_photons).
+    
+    inputs:
+        sd_list: photon source densities from read_source_mesh
+        stage_duration: time offset [s] between stages, much longer than any particle history (float)
+    outputs:
+        model: OpenMC Model object
+        photon_tally_ids: list of IDs (int) of the time-filtered photon tallies
+        events_tally_id: ID (int) of the photon events tally with one bin per stage
+    '''
+    settings_info = inputs['settings_info']
+    geom_info = inputs['geom_info']
+    mesh_file = inputs['filename_dict']['mesh_file']
+    bounds = inputs['source_info']['phtn_e_bounds']
+    num_decay_times = len(inputs['source_meshes'])
+    unstructured_mesh = openmc.UnstructuredMesh(mesh_file, library='moab')
+    element_cell_ids, element_material_ids, element_overlaps = make_element_cell_index(mesh_file,
+                inputs['filename_dict']['cell_index_file'],
+                geometry,
+                geom_info['inner_radius'],
+                geom_info['thicknesses'])
+    tallied_cells = list(geometry.get_all_material_cells().values())
+    material_columns = [cell.fill is not None for cell in geometry.get_all_cells().values()]
+    element_in_material = element_overlaps[:, material_columns].any(axis=1)
+
+    neutron_source = make_neutron_source(inputs['particle_energy'])
+    neutron_source.time = make_stage_time(0, stage_duration)
+    source_list = [neutron_source]
+    for source_mesh_index in range(num_decay_times):
+        photon_sources, unstructured_mesh = make_photon_sources(bounds, element_in_material, tallied_cells, mesh_file, source_mesh_index, sd_list, unstructured_mesh)
+        total_strength = sum(source.strength for source in photon_sources)
+        if total_strength <= 0.0:
+            raise ValueError(f"{inputs['source_meshes'][source_mesh_index]} has no photon source in the material cells, "
+                             "so its decay time cannot be given an equal share of the particles")
+        for source in photon_sources:
+            source.strength /= total_strength
+            source.time = make_stage_time(source_mesh_index + 1, stage_duration)
+        source_list += photon_sources
+
+    # Photon tallies take fixed IDs, so they are created before the automatically numbered neutron tallies
+    photon_tallies = make_photon_tallies(unstructured_mesh, tallied_cells, inputs['coeff_geom'], bounds, element_overlaps, list(geometry.get_all_cells()))
+    time_filter = openmc.TimeFilter(stage_duration * np.arange(1, num_decay_times + 2))
+    for tally in photon_tallies:
+        tally.filters = [time_filter] + tally.filters
+    neutron_tallies = make_neutron_tallies(mesh_file, unstructured_mesh)
+    events_tally = openmc.Tally(name="Photon events by stage")
+    events_tally.filters = [openmc.TimeFilter(stage_duration * np.arange(0, num_decay_times + 2)), openmc.ParticleFilter('photon')]
+    events_tally.scores = ['events']
+
+    sets = make_settings(source_list,
+                settings_info['total_batches'], 
+                settings_info['inactive_batches'], 
+                settings_info['num_particles'] * (num_decay_times + 1), 
+                settings_info['run_mode'])
+    sets.photon_transport = True
+    model = openmc.model.Model(geometry = geometry, materials = materials, settings = sets, 
+                tallies = openmc.Tallies(list(photon_tallies) + list(neutron_tallies) + [events_tally]))
+    return model, [tally.id for tally in photon_tallies], events_tally.id
+
 def main():
     args = parse_args()
     inputs = read_yaml(args)
     materials = create_materials_obj(inputs)
     geometry = create_geometry_obj(materials, inputs)
 
+    if args.in_process.lower() == 'true':
+        sd_list = read_source_mesh(inputs)
+        model, photon_tally_ids, events_tally_id = create_in_process_model(inputs, materials, geometry, sd_list)
+        neutron_means, photon_means = run_r2s_in_process(model, 
+                    photon_tally_ids, 
+                    events_tally_id, 
+                    len(inputs['source_meshes']), 
+                    args.in_process_dir, 
+                    args.threads, 
+                    args.restart.lower() == 'true', 
+                    args.checkpoint_interval)
+        save_stage_means(neutron_means, photon_means, args.in_process_results)
+        return neutron_means, photon_means
+
     if args.neutron_transport == True:
         neutron_model = create_neutron_model(inputs, materials, geometry)
         neutron_model.export_to_model_xml(path="neutron_model.xml")
@@ -0,0 +1,256 @@
+import openmc
+import openmc.deplete
+import numpy as np
+import pandas as pd
+import yaml
+import argparse
+import copy
+import importlib
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# The R2S script name is not a valid identifier, so it is imported by name
+r2s = importlib.import_module('OpenMC-to-ALARA_R2S')
+
+#Generate design points:
+
+def make_design_points(base_inputs, layer_elements, thicknesses, particle_energies):
+    '''
+    Creates one set of model inputs for every combination of swept parameters.
+    Combinations whose element and thickness lists differ in length are skipped, so
+    models with different numbers of layers can be swept together.
+
+    inputs:
+        base_inputs: dictionary of model inputs read from OpenMC_ALARA_WC.yaml
+        layer_elements: iterable of lists of elemental symbols (str), radially innermost to outermost
+        thicknesses: iterable of lists of layer thicknesses (float), radially innermost to outermost
+        particle_energies: iterable of source neutron energies [eV] (float)
+
+    outputs:
+        design_points: list of tuples of (elements, thicknesses, particle energy) and the model inputs for that point
+    '''
+    design_points = []
+    for elements, layer_thicknesses, energy in itertools.product(layer_elements, thicknesses, particle_energies):
+        if len(elements) != len(layer_thicknesses):
+            continue
+        point_inputs = copy.deepcopy(base_inputs)
+        point_inputs['mat_info']['element_list'] = list(elements)
+        point_inputs['geom_info']['thicknesses'] = list(layer_thicknesses)
+        point_inputs['particle_energy'] = energy
+        params = ('-'.join(elements), '-'.join(str(thickness) for thickness in layer_thicknesses), energy)
+        design_points.append((params, point_inputs))
+    return design_points
+
+def layer_volumes(inner_radius, thicknesses):
+    '''
+    Returns a numpy array of the volumes of the spherical shells built by make_spherical_shells.
+    '''
+    radii = inner_radius + np.cumsum(np.concatenate(([0.0], thicknesses)))
+    return 4.0/3.0 * np.pi * np.diff(radii**3)
+
+#Build the model of one design point:
+
+def make_layer_tally(tallied_cells):
+    '''
+    Creates a neutron flux and absorption tally with one bin per layer.
+
+    inputs:
+        tallied_cells: iterable of OpenMC Cell objects, radially innermost to outermost
+    '''
+    layer_tally = openmc.Tally(name="Layer tally")
+    layer_tally.filters = [openmc.CellFilter(tallied_cells), openmc.ParticleFilter('neutron')]
+    layer_tally.scores = ['flux', 'absorption']
+    return layer_tally
+
+def make_dose_tally(tallied_cells, coeff_geom):
+    '''
+    Creates a neutron effective dose tally over the tallied cells.
+
+    inputs:
+        tallied_cells: iterable of OpenMC Cell objects
+        coeff_geom : irradation geometry associated with dose coefficient calculation
+    '''
+    dose_energy, dose = openmc.data.dose_coefficients('neutron', geometry=coeff_geom)
+    dose_tally = openmc.Tally(name="Neutron dose")
+    dose_tally.filters = [openmc.CellFilter(tallied_cells), openmc.ParticleFilter('neutron'), openmc.EnergyFunctionFilter(dose_energy, dose)]
+    dose_tally.scores = ['flux']
+    return dose_tally
+
+def create_layer_model(point_inputs, coeff_geom):
+    '''
+    Builds the multi-layer neutron transport model of one design point with the R2S model functions.
+
+    inputs:
+        point_inputs: dictionary of model inputs for this point
+        coeff_geom : irradation geometry associated with dose coefficient calculation
+    '''
+    settings_info = point_inputs['settings_info']
+    materials = r2s.create_materials_obj(point_inputs)
+    geometry = r2s.create_geometry_obj(materials, point_inputs)
+    settings = r2s.make_settings(r2s.make_neutron_source(point_inputs['particle_energy']),
+                    settings_info['total_batches'],
+                    settings_info['inactive_batches'],
+                    settings_info['num_particles'],
+                    settings_info['run_mode'])
+    tallied_cells = list(geometry.get_all_material_cells().values())
+    tallies = openmc.Tallies([make_layer_tally(tallied_cells), make_dose_tally(tallied_cells, coeff_geom)])
+    model = openmc.model.Model(geometry = geometry, materials = materials, settings = settings, tallies = tallies)
+    return model
+
+#Run and collect one design point:
+
+def deplete_layers(model, volumes, dep_params, num_products):
+    '''
+    Depletes every layer of the model in the current directory and returns the nuclides with the
+    highest activity summed over all layers.
+
+    inputs:
+        model: OpenMC Model object of the design point
+        volumes: iterable of layer volumes [cm3] in the order of model.materials
+        dep_params: dictionary of depletion inputs from the sweep YAML file
+        num_products: number of activation products (by activity) to report (int)
+
+    outputs:
+        top_products: string of the num_products nuclides with the highest activity [Bq]
+    '''
+    for material, volume in zip(model.materials, volumes):
+        material.depletable = True
+        material.volume = volume
+    # Template from which the depleted compositions are exported
+    model.materials.export_to_xml('materials.xml')
+    volumes_by_id = {material.id: material.volume for material in model.materials}
+    operator = openmc.deplete.CoupledOperator(model, dep_params['chain_file'], normalization_mode = dep_params['norm_mode'])
+    integrator = openmc.deplete.PredictorIntegrator(operator,
+                    dep_params['times_post_boc'],
+                    source_rates = dep_params['source_rates'],
+                    timestep_units = dep_params['timestep_units'])
+    integrator.integrate()
+    dep_results = openmc.deplete.Results('depletion_results.h5')
+    activities = {}
+    for material in dep_results.export_to_materials(-1, path='materials.xml'):
+        material.volume = volumes_by_id[material.id]
+        for nuclide, activity in material.get_activity(units='Bq', by_nuclide=True).items():
+            activities[nuclide] = activities.get(nuclide, 0.0) + activity
+    top_products = sorted(activities, key=activities.get, reverse=True)[:num_products]
+    return ', '.join(f'{nuclide}:{activities[nuclide]:.3e}' for nuclide in top_products)
+
+def run_design_point(point_inputs, run_dir, threads, run_depletion, num_products, coeff_geom, dep_params):
+    '''
+    Builds, runs and (optionally) depletes the model of one design point in its own directory,
+    then reduces its outputs to a single row of key results.
+
+    inputs:
+        point_inputs: dictionary of model inputs for this point
+        run_dir: directory in which OpenMC writes this point's outputs (str)
+        threads: number of OpenMC threads for this point (int)
+        run_depletion: whether to run the depletion simulation (bool)
+        num_products: number of activation products (by activity) to report (int)
+        coeff_geom : irradation geometry associated with dose coefficient calculation
+        dep_params: dictionary of depletion inputs from the sweep YAML file
+
+    outputs:
+        results: dictionary of key results for this point
+    '''
+    os.makedirs(run_dir, exist_ok=True)
+    model = create_layer_model(point_inputs, coeff_geom)
+    statepoint = model.run(cwd=run_dir, threads=threads)
+
+    results = {}
+    with openmc.StatePoint(statepoint) as sp:
+        layer_tally = sp.get_tally(name="Layer tally")
+        dose_tally = sp.get_tally(name="Neutron dose")
+        layer_fluxes = layer_tally.get_values(scores=['flux']).ravel()
+        layer_absorption = layer_tally.get_values(scores=['absorption']).ravel()
+        for layer, element in enumerate(point_inputs['mat_info']['element_list']):
+            results[f'flux layer {layer + 1} ({element})'] = layer_fluxes[layer]
+            results[f'absorption layer {layer + 1} ({element})'] = layer_absorption[layer]
+        results['dose [pSv-cm3/source]'] = dose_tally.get_values(scores=['flux']).sum()
+
+    if run_depletion:
+        geom_info = point_inputs['geom_info']
+        volumes = layer_volumes(geom_info['inner_radius'], geom_info['thicknesses'])
+        # Depletion writes its inputs and results to the current directory
+        cwd = os.getcwd()
+        os.chdir(run_dir)
+        try:
+            results['top activation products [Bq]'] = deplete_layers(model, volumes, dep_params, num_products)
+        finally:
+            os.chdir(cwd)
+    return results
+
+def run_sweep(design_points, sweep_dir, max_concurrent_runs, threads_per_run, run_depletion, num_products, coeff_geom, dep_params):
+    '''
+    Runs every design point across a local process pool and collects their key results.
+
+    inputs:
+        design_points: output of make_design_points
+        sweep_dir: directory under which each design point gets its own run directory (str)
+        max_concurrent_runs: maximum number of OpenMC runs at once (int)
+        threads_per_run: number of OpenMC threads for each run (int)
+        run_depletion: whether to run the depletion simulation for each point (bool)
+        num_products: number of activation products (by activity) to report (int)
+        coeff_geom : irradation geometry associated with dose coefficient calculation
+        dep_params: dictionary of depletion inputs from the sweep YAML file
+
+    outputs:
+        results_table: pandas DataFrame of key results indexed by layer elements, thicknesses and particle energy
+    '''
+    # The OpenMP runtime of openmc.lib (used by depletion) reads the thread count when it is first loaded.
+    # Spawned workers start from a fresh interpreter and inherit this environment before importing openmc.
+    os.environ['OMP_NUM_THREADS'] = str(threads_per_run)
+    with ProcessPoolExecutor(max_workers=max_concurrent_runs, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = []
+        for params, point_inputs in design_points:
+            run_dir = os.path.join(sweep_dir, '_'.join(str(param) for param in params))
+            futures.append(pool.submit(run_design_point, point_inputs, run_dir,
+                                       threads_per_run, run_depletion, num_products, coeff_geom, dep_params))
+        rows = [future.result() for future in futures]
+    index = pd.MultiIndex.from_tuples([params for params, point_inputs in design_points],
+                                      names=['layer_elements', 'thicknesses', 'particle_energy'])
+    results_table = pd.DataFrame(rows, index=index)
+    return results_table
+
+# Specify inputs and execute all functions:
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--yaml_filepath', default = 'OpenMC_ALARA_WC.yaml', help="Path to YAML file containing required inputs for the base model (str)")
+    parser.add_argument('--sweep_yaml_filepath', default = 'Sweep_YAML.yaml', help="Path to YAML file containing the parameter ranges and run settings of the sweep (str)")
+    args = parser.parse_args()
+    return args
+
+def read_yamls(args):
+    with open(args.yaml_filepath, 'r') as model_file:
+        base_inputs = yaml.safe_load(model_file)
+    with open(args.sweep_yaml_filepath, 'r') as sweep_file:
+        sweep_inputs = yaml.safe_load(sweep_file)
+    return base_inputs, sweep_inputs
+
+def main():
+    args = parse_args()
+    base_inputs, sweep_inputs = read_yamls(args)
+    dep_params = sweep_inputs['depletion_params']
+    # Every design point runs in its own directory, so data files are referenced by absolute path
+    base_inputs['filename_dict']['elelib_fp'] = os.path.abspath(base_inputs['filename_dict']['elelib_fp'])
+    dep_params['chain_file'] = os.path.abspath(dep_params['chain_file'])
+
+    ranges = sweep_inputs['parameter_ranges']
+    run_info = sweep_inputs['run_info']
+    design_points = make_design_points(base_inputs,
+                    ranges['layer_elements'],
+                    ranges['thicknesses'],
+                    ranges['particle_energies'])
+    results_table = run_sweep(design_points,
+                    os.path.abspath(run_info['sweep_dir']),
+                    run_info['max_concurrent_runs'],
+                    run_info['threads_per_run'],
+                    run_info['run_depletion'],
+                    run_info['num_products'],
+                    run_info['coeff_geom'],
+                    dep_params)
+    results_table.to_csv(run_info['results_filename'])
+
+if __name__ == "__main__":
+    main()
@@ -4,46 +4,63 @@ import yaml
 import argparse
 import numpy as np
 
-def read_statepoint(sp_filename, flux_spectrum_tally_id, axes_without_energy_bins, energy_filter_index, mesh_number):
+# Shared statepoint reader at the repository root (run with the repository root on PYTHONPATH)
+from Tally_Reader import read_tally_mean, read_filter_sums, read_filter_types, read_filter_bins, read_tally_scores, read_mesh
+
+def read_statepoint(sp_filename, photon_tally_id, flux_spectrum_tally_id):
     '''
-    Reads OpenMC Statepoint file and returns energy bins and flux from reshaped data.
+    Reads OpenMC Statepoint file and returns energy bins, the photon tally and the flux spectrum summed
+    along its energy, mesh and dose filters.
+    The flux spectrum tally is read in chunks (see read_filter_sums), so memory use does not grow with
+    the mesh size. Its energy, mesh and dose axes are found from its filter types, so the tally may or may 
+    not carry a cell filter (see optimize_tally_layout in OpenMC-to-ALARA_R2S.py).
     
     inputs: 
         sp_filename : path to OpenMC Statepoint file
+        photon_tally_id : id of photon tally with energy filter
         flux_spectrum_tally_id : id of flux tally with energy filter
-        axes_without_energy_bins: n-tuple of axes over which tally data is summed in order to isolate axis with energy bounds
-        energy_filter_index: index of energy filter within flux tally
-        mesh_number: mesh id of OpenMC unstructured mesh
-        
+    outputs:
+        photon_tally_scores : list of scores (str) of the photon tally
+        photon_tally_values : numpy array of photon tally means with rows = energy bins and columns = scores
+        phtn_tally_e_filter_lower : lower bounds of the photon tally energy bins
+        e_filter_lower : lower bounds of the flux spectrum energy bins
+        energy_binned_flux : flux spectrum summed over every filter but energy
+        mesh_data : flux spectrum summed over every filter but the mesh, one value per mesh element
+        total_dose : flux spectrum summed over every filter but the dose filter
+        mesh : OpenMC Unstructured Mesh object of the mesh filter
     '''
-    with openmc.StatePoint(sp_filename) as sp:
-        photon_tally = sp.get_tally(id = photon_tally_id)
-        phtn_tally_e_filter_lower = photon_tally.filters[0].bins[:,0]
-        
-        flux_spectrum_tally = sp.get_tally(id=flux_spectrum_tally_id) 
-        mesh=sp.meshes[mesh_number]
-        # Return tally data condensed into 1 dimension per filter
-        flux_spectrum_mean = flux_spectrum_tally.get_reshaped_data(value='mean')
-        energy_binned_flux = flux_spectrum_mean.sum(axis=eval(axes_without_energy_bins))   
-        #Vitamin-J energy filter:
-        e_filter = flux_spectrum_tally.filters[energy_filter_index]
-        #Lower bounds of the energy bins
-        e_filter_lower = e_filter.bins[:, 0]
-    return photon_tally, phtn_tally_e_filter_lower, e_filter_lower, energy_binned_flux, flux_spectrum_mean, mesh
+    # The photon tally only has energy (and, for in-process runs, time) bins, so it is read in full
+    photon_filter_types = read_filter_types(sp_filename, photon_tally_id)
+    photon_energy_index = photon_filter_types.index('energy')
+    photon_tally_scores = read_tally_scores(sp_filename, photon_tally_id)
+    photon_tally_mean = np.moveaxis(read_tally_mean(sp_filename, photon_tally_id), photon_energy_index, 0)
+    photon_tally_values = photon_tally_mean.reshape(photon_tally_mean.shape[0], -1, len(photon_tally_scores)).sum(axis=1)
+    phtn_tally_e_filter_lower = read_filter_bins(sp_filename, photon_tally_id, photon_energy_index)[:-1]
 
-def plot_photon_tally(photon_tally, phtn_tally_e_filter_lower,  photon_tally_figname):
+    filter_types = read_filter_types(sp_filename, flux_spectrum_tally_id)
+    energy_filter_index = filter_types.index('energy')
+    mesh_filter_index = filter_types.index('mesh')
+    energy_binned_flux, mesh_data, total_dose = read_filter_sums(sp_filename, 
+                      flux_spectrum_tally_id, 
+                      [energy_filter_index, mesh_filter_index, filter_types.index('energyfunction')])
+    #Lower bounds of the Vitamin-J energy bins
+    e_filter_lower = read_filter_bins(sp_filename, flux_spectrum_tally_id, energy_filter_index)[:-1]
+    mesh_id = int(np.ravel(read_filter_bins(sp_filename, flux_spectrum_tally_id, mesh_filter_index))[0])
+    mesh = read_mesh(sp_filename, mesh_id)
+    return photon_tally_scores, photon_tally_values, phtn_tally_e_filter_lower, e_filter_lower, energy_binned_flux, mesh_data, total_dose, mesh
+
+def plot_photon_tally(photon_tally_scores, photon_tally_values, phtn_tally_e_filter_lower,  photon_tally_figname):
     '''
     Plots flux and absorption tallies as a function of energy bounds from ALARA
     inputs:
-        photon_tally : OpenMC Tally object with applied energy filter
+        photon_tally_scores : list of scores (str) of the photon tally
+        photon_tally_values : numpy array of photon tally means with rows = energy bins and columns = scores
         phtn_e_filter_lower : iterable of lower bounds of each energy bin
         photon_tally_figname : file name of the plot of flux & absorption vs energy
     '''
     fix, ax = plt.subplots()
-    for score in photon_tally.scores:
-        score_slice = photon_tally.get_slice(scores=[score])
-        score_slice_values = score_slice.get_values(value='mean').ravel()
-        plt.loglog(phtn_tally_e_filter_lower, score_slice_values, label=score)
+    for score_index, score in enumerate(photon_tally_scores):
+        plt.loglog(phtn_tally_e_filter_lower, photon_tally_values[:, score_index], label=score)
     plt.legend()
     ax.set_xlabel('Energy [eV]')
     ax.set_ylabel('Tally Value [photon-cm/source]')
@@ -67,17 +84,32 @@ def plot_flux_data(e_filter_lower, energy_binned_flux, figure_filename):
     plt.savefig(figure_filename)
     plt.show()
 
-def save_summed_data_to_vtk(flux_spectrum_mean, axes_without_mesh, vtk_filename, mesh):
+def summarize_by_cell(mesh_data, element_cell_ids):
+    '''
+    Sums mesh tally data over the elements of each geometry cell.
+    inputs:
+        mesh_data: iterable of tally values, one per mesh element
+        element_cell_ids: numpy array of cell IDs, one per mesh element (from the *_cell_index.npz file)
+    outputs:
+        dictionary with keys = cell ID (int) and values = summed tally value (float)
+    '''
+    cell_ids, element_cells = np.unique(element_cell_ids, return_inverse=True)
+    cell_sums = np.bincount(element_cells, weights=np.ravel(mesh_data))
+    return dict(zip(cell_ids.tolist(), cell_sums))
+
+def save_summed_data_to_vtk(mesh_data, vtk_filename, mesh, element_cell_ids=None):
     '''
     Saves mesh tally data in vtk format.
     inputs:
-        flux_spectrum_mean: reshaped flux spectrum data from read_statepoint
-        axes_without_mesh: n-tuple of axes over which tally data is summed in order to isolate axis containing mesh elements
+        mesh_data: flux spectrum data summed over every filter but the mesh, from read_statepoint
         vtk_filename: name of file saved in vtk format
         mesh: OpenMC Unstructured Mesh object
+        element_cell_ids: numpy array of cell IDs, one per mesh element, saved alongside the tally data if given
     '''
-    mesh_data = flux_spectrum_mean.sum(axis=eval(axes_without_mesh))
-    mesh.write_data_to_vtk(filename=vtk_filename, datasets={"mean":mesh_data.flatten()})
+    datasets = {"mean":mesh_data.flatten()}
+    if element_cell_ids is not None:
+        datasets["cell"] = element_cell_ids.astype(float)
+    mesh.write_data_to_vtk(filename=vtk_filename, datasets=datasets)
 
 def main():
     def parse_args():
@@ -92,23 +124,25 @@ def main():
         return inputs
     
     def save_photon_tally_vtk(inputs):
-       photon_tally, phtn_tally_e_filter_lower, e_filter_lower, energy_binned_flux, flux_spectrum_mean, mesh = read_statepoint(inputs['filename_dict']['sp_filename'], 
+        (photon_tally_scores, photon_tally_values, phtn_tally_e_filter_lower, e_filter_lower, 
+         energy_binned_flux, mesh_data, total_dose, mesh) = read_statepoint(inputs['filename_dict']['sp_filename'], 
                                                                               inputs['file_indices']['photon_tally_id'],
-                                                                               inputs['file_indices']['flux_spectrum_tally_id'],
-                                                                               inputs['axes_without_energy_bins'], 
-                                                                               inputs['file_indices']['energy_filter_index'],
-                                                                               inputs['file_indices']['mesh_number'])
-        photon_tally_plot = plot_photon_tally(photon_tally, phtn_tally_e_filter_lower,
+                                                                               inputs['file_indices']['flux_spectrum_tally_id'])
+        photon_tally_plot = plot_photon_tally(photon_tally_scores, photon_tally_values, phtn_tally_e_filter_lower,
                                               inputs['filename_dict']['photon_tally_figname'])
         flux_data_plot = plot_flux_data(e_filter_lower, energy_binned_flux,
                                         inputs['filename_dict']['figure_filename'])
-
-        total_dose = flux_spectrum_mean.sum(axis=eval(inputs['axes_without_dose_filter_bin']))
         
-        vtk_file = save_summed_data_to_vtk(flux_spectrum_mean, 
-                          inputs['axes_without_mesh'], 
+        element_cell_ids = None
+        if 'cell_index_file' in inputs['filename_dict']:
+            element_cell_ids = np.load(inputs['filename_dict']['cell_index_file'])['cell_ids']
+        save_summed_data_to_vtk(mesh_data, 
                           inputs['filename_dict']['vtk_filename'], 
-                          mesh)
+                          mesh,
+                          element_cell_ids)
+        if element_cell_ids is not None:
+            for cell_id, cell_sum in summarize_by_cell(mesh_data, element_cell_ids).items():
+                print(f"Cell {cell_id}: {cell_sum}")
         
     args = parse_args()
     inputs = read_yaml(args)